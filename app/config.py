@@ -1,11 +1,16 @@
-import json
+import logging
 import os
+from dataclasses import dataclass, fields
 from pathlib import Path
+from types import MappingProxyType
 
+import orjson
 from dotenv import load_dotenv
 
 load_dotenv()
 
+log = logging.getLogger("soc")
+
 OLLAMA_BASE_URL = os.getenv("OLLAMA_BASE_URL", "http://localhost:11434")
 OLLAMA_API_KEY = os.getenv("OLLAMA_API_KEY", "")
 OLLAMA_MODEL = os.getenv("OLLAMA_MODEL", "llama3")
@@ -13,14 +18,59 @@ OLLAMA_TIMEOUT = int(os.getenv("OLLAMA_TIMEOUT", "120"))
 
 REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379")
 DEDUP_WINDOW = int(os.getenv("DEDUP_WINDOW", "300"))
+LLM_CACHE_TTL = int(os.getenv("LLM_CACHE_TTL", "600"))
+LLM_LOCAL_CACHE_TTL = int(os.getenv("LLM_LOCAL_CACHE_TTL", str(LLM_CACHE_TTL)))
+LLM_BATCH_MAX = int(os.getenv("LLM_BATCH_MAX", "1"))
+LLM_BATCH_WINDOW_MS = int(os.getenv("LLM_BATCH_WINDOW_MS", "30"))
 MIN_LEVEL = int(os.getenv("MIN_LEVEL", "8"))
+AUDIT_SIZE = int(os.getenv("AUDIT_SIZE", "10000"))
+AUDIT_LOG = os.getenv("AUDIT_LOG", "")
+BATCH_SIZE = int(os.getenv("BATCH_SIZE", "4"))
+QUEUE_WORKERS = int(os.getenv("QUEUE_WORKERS", "2"))
+SSH_WORKERS = int(os.getenv("SSH_WORKERS", "4"))
+SSH_IDLE_TIMEOUT = int(os.getenv("SSH_IDLE_TIMEOUT", "300"))
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+ENABLE_CORS = os.getenv("ENABLE_CORS") == "1"
 
 _AGENTS_FILE = os.getenv("AGENTS_FILE", "agents.json")
+_RULES_FILE = os.getenv("RULES_FILE", "rules.json")
+
+
+@dataclass(slots=True, frozen=True)
+class AgentConfig:
+    host: str
+    username: str
+    port: int = 22
+    password: str | None = None
+    key_file: str | None = None
+    os: str = "ubuntu"
 
 
-def load_agents() -> dict:
+_AGENT_FIELDS = frozenset(f.name for f in fields(AgentConfig))
+
+
+def load_agents() -> MappingProxyType:
     path = Path(_AGENTS_FILE)
     if not path.exists():
-        return {}
-    with open(path) as f:
-        return json.load(f)
+        return MappingProxyType({})
+    raw = orjson.loads(path.read_bytes())
+    agents = {}
+    for name, agent in raw.items():
+        unknown = agent.keys() - _AGENT_FIELDS
+        if unknown:
+            log.warning("Agent '%s': ignoring unknown key(s) %s", name, sorted(unknown))
+        agents[name] = AgentConfig(**{k: v for k, v in agent.items() if k in _AGENT_FIELDS})
+    return MappingProxyType(agents)
+
+
+def agents_mtime() -> float:
+    path = Path(_AGENTS_FILE)
+    return path.stat().st_mtime if path.exists() else 0.0
+
+
+def load_rule_table() -> MappingProxyType:
+    path = Path(_RULES_FILE)
+    if not path.exists():
+        return MappingProxyType({})
+    return MappingProxyType(orjson.loads(path.read_bytes()))
@@ -1,10 +1,59 @@
 import asyncio
 import logging
+import time
 
 import asyncssh
 
+from .config import SSH_IDLE_TIMEOUT
+
 log = logging.getLogger("soc")
 
+_conn_cache: dict[tuple, asyncssh.SSHClientConnection] = {}
+_conn_used: dict[tuple, float] = {}
+_conn_locks: dict[tuple, asyncio.Lock] = {}
+
+# The session channel never opened, so the command cannot have started:
+# safe to retry once on a fresh connection. Any later transport failure may
+# hit a script that is already running and is reported, never retried.
+_STALE_ERRORS = (asyncssh.ChannelOpenError,)
+# The transport is gone; other failures (timeouts, command errors) leave the
+# multiplexed connection usable for concurrent sessions.
+_BROKEN_ERRORS = (asyncssh.DisconnectError, ConnectionError)
+
+
+async def _get_conn(key: tuple, connect_args: dict) -> tuple[asyncssh.SSHClientConnection, bool]:
+    """Return a pooled connection for *key* and whether it was reused."""
+    async with _conn_locks.setdefault(key, asyncio.Lock()):
+        conn = _conn_cache.get(key)
+        reused = conn is not None and not conn.is_closed()
+        if not reused:
+            conn = await asyncssh.connect(**connect_args, connect_timeout=15, keepalive_interval=30)
+            _conn_cache[key] = conn
+        _conn_used[key] = time.monotonic()
+        return conn, reused
+
+
+def _drop_conn(key: tuple):
+    conn = _conn_cache.pop(key, None)
+    _conn_used.pop(key, None)
+    if conn is not None:
+        conn.close()
+
+
+async def reap_idle_connections():
+    while True:
+        await asyncio.sleep(SSH_IDLE_TIMEOUT / 2)
+        cutoff = time.monotonic() - SSH_IDLE_TIMEOUT
+        for key, used in list(_conn_used.items()):
+            if used < cutoff:
+                log.info("  SSH closing idle connection to %s@%s:%d", key[2], key[0], key[1])
+                _drop_conn(key)
+
+
+async def close_connections():
+    for key in list(_conn_cache):
+        _drop_conn(key)
+
 
 async def run_ssh(host: str, port: int, username: str, script: str,
                   password: str | None = None, key_file: str | None = None,
@@ -27,31 +76,46 @@ async def run_ssh(host: str, port: int, username: str, script: str,
     else:
         command = f'bash -c {repr(script)}'
 
-    log.info("  SSH connecting to %s@%s:%d (%s)...", username, host, port, target_os)
+    log.debug("  SSH connecting to %s@%s:%d (%s)...", username, host, port, target_os)
 
-    try:
-        conn = await asyncio.wait_for(asyncssh.connect(**connect_args), timeout=15)
-    except Exception as e:
-        log.error("  SSH connection failed: %s", e)
-        return {"success": False, "output": "", "error": f"SSH connection failed: {e}"}
+    key = (host, port, username)
+    while True:
+        try:
+            conn, reused = await _get_conn(key, connect_args)
+        except Exception as e:
+            log.error("  SSH connection failed: %s", e)
+            return {"success": False, "output": "", "error": f"SSH connection failed: {e}"}
 
-    log.info("  SSH connected. Running command...")
+        log.debug("  SSH connected%s. Running command...", " (pooled)" if reused else "")
 
-    async with conn:
         try:
-            result = await asyncio.wait_for(conn.run(command), timeout=30)
+            result = await conn.run(command, timeout=30, check=False)
+            break
+        except _STALE_ERRORS as e:
+            _drop_conn(key)
+            if reused:
+                log.warning("  SSH pooled connection went stale (%s) — reconnecting", e)
+                continue
+            log.error("  SSH command failed: %s", e)
+            return {"success": False, "output": "", "error": f"Execution failed: {e}"}
+        except _BROKEN_ERRORS as e:
+            log.error("  SSH command failed: %s", e)
+            _drop_conn(key)
+            return {"success": False, "output": "", "error": f"Execution failed: {e}"}
         except Exception as e:
             log.error("  SSH command failed: %s", e)
             return {"success": False, "output": "", "error": f"Execution failed: {e}"}
+    _conn_used[key] = time.monotonic()
 
     stdout = (result.stdout or "").strip()
     stderr = (result.stderr or "").strip()
 
-    log.info("  SSH exit code: %d", result.exit_status)
-    if stdout:
-        log.info("  SSH stdout: %s", stdout[:300])
-    if stderr:
-        log.info("  SSH stderr: %s", stderr[:300])
+    log.debug("  SSH exit code: %d", result.exit_status)
+    if log.isEnabledFor(logging.DEBUG):
+        if stdout:
+            log.debug("  SSH stdout: %s", stdout[:300])
+        if stderr:
+            log.debug("  SSH stderr: %s", stderr[:300])
 
     return {
         "success": result.exit_status == 0,
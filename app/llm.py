@@ -1,8 +1,8 @@
-import json
 import logging
 import re
 
 import httpx
+import orjson
 
 from .config import OLLAMA_API_KEY, OLLAMA_BASE_URL, OLLAMA_MODEL, OLLAMA_TIMEOUT
 
@@ -41,34 +41,160 @@ SCRIPT RULES:
 Return ONLY valid JSON. No markdown. No explanation outside the JSON.
 """
 
+BATCH_PROMPT = SYSTEM_PROMPT + """
+BATCH MODE:
+You receive several alerts in "alerts", all for the same target OS. Return ONLY a JSON object
+{"decisions": [...]} with exactly one decision object (fields as above) per alert, in the same order.
+"""
 
-async def ask_ollama(alert: dict, target_os: str) -> dict:
-    user_msg = json.dumps({"alert": alert, "target_os": target_os}, indent=2)
-    payload = {
+_FENCE_OPEN = re.compile(r"^```(?:json)?\s*")
+_FENCE_CLOSE = re.compile(r"\s*```$")
+
+# "action" is the first field of the schema; once the model has committed to
+# IGNORE there is nothing left worth generating.
+_EARLY_IGNORE = re.compile(r'"action"\s*:\s*"IGNORE"')
+_EARLY_WINDOW = 256
+
+# Only these alert fields inform the decision; timestamps and empty defaults
+# just add prompt tokens.
+_PROMPT_FIELDS = ("rule", "agent", "data", "full_log")
+MAX_LOG_CHARS = 500
+
+IGNORE_DECISION = {
+    "action": "IGNORE",
+    "severity": "low",
+    "summary": "Model chose IGNORE.",
+    "reason": "Generation stopped early once the action was IGNORE.",
+    "script": "",
+}
+
+_client: httpx.AsyncClient | None = None
+
+
+async def init_client():
+    global _client
+    if _client is None:
+        # Bodies are encoded with orjson and sent as content=, so the JSON
+        # content type is set once here.
+        headers = {"Content-Type": "application/json"}
+        if OLLAMA_API_KEY:
+            headers["Authorization"] = f"Bearer {OLLAMA_API_KEY}"
+        _client = httpx.AsyncClient(
+            base_url=OLLAMA_BASE_URL,
+            headers=headers,
+            timeout=OLLAMA_TIMEOUT,
+            limits=httpx.Limits(max_connections=64, max_keepalive_connections=32),
+        )
+
+
+async def close_client():
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+
+def _prompt_alert(alert: dict) -> dict:
+    view = {}
+    for field in _PROMPT_FIELDS:
+        value = alert.get(field)
+        if field in ("rule", "agent") and value:
+            value = {k: v for k, v in value.items() if v != "" and v != 0}
+        elif field == "full_log" and value:
+            value = value[:MAX_LOG_CHARS]
+        if value:
+            view[field] = value
+    return view
+
+
+def _payload(system: str, user_msg: str, stream: bool, num_predict: int = 2048) -> dict:
+    return {
         "model": OLLAMA_MODEL,
         "messages": [
-            {"role": "system", "content": SYSTEM_PROMPT},
+            {"role": "system", "content": system},
             {"role": "user", "content": user_msg},
         ],
-        "stream": False,
+        "stream": stream,
         "format": "json",
-        "options": {"temperature": 0.1, "num_predict": 2048},
+        "options": {"temperature": 0.1, "num_predict": num_predict},
     }
 
-    headers = {}
-    if OLLAMA_API_KEY:
-        headers["Authorization"] = f"Bearer {OLLAMA_API_KEY}"
-
-    log.info("  Ollama POST %s/api/chat  model=%s", OLLAMA_BASE_URL, OLLAMA_MODEL)
 
-    async with httpx.AsyncClient(timeout=OLLAMA_TIMEOUT) as client:
-        resp = await client.post(f"{OLLAMA_BASE_URL}/api/chat", json=payload, headers=headers)
-        resp.raise_for_status()
+def _error_decision(status_code: int) -> dict:
+    log.error("  Ollama returned HTTP %d", status_code)
+    return {
+        **IGNORE_DECISION,
+        "summary": f"Ollama {status_code}",
+        "reason": "Ollama returned an error, defaulting to IGNORE.",
+        "llm_error": f"HTTP {status_code}",
+    }
 
-    raw = resp.json().get("message", {}).get("content", "")
-    log.info("  Ollama responded (%d chars)", len(raw))
 
+def _parse(raw: str):
     text = raw.strip()
-    text = re.sub(r"^```(?:json)?\s*", "", text)
-    text = re.sub(r"\s*```$", "", text)
-    return json.loads(text)
+    if text.startswith("```"):
+        text = _FENCE_OPEN.sub("", text)
+        text = _FENCE_CLOSE.sub("", text)
+    return orjson.loads(text)
+
+
+async def ask_ollama(alert: dict, target_os: str) -> dict:
+    user_msg = orjson.dumps({"alert": _prompt_alert(alert), "target_os": target_os}).decode()
+    payload = _payload(SYSTEM_PROMPT, user_msg, stream=True)
+
+    log.debug("  Ollama POST %s/api/chat  model=%s", OLLAMA_BASE_URL, OLLAMA_MODEL)
+
+    if _client is None:
+        await init_client()
+    parts: list[str] = []
+    head = ""
+    async with _client.stream("POST", "/api/chat", content=orjson.dumps(payload)) as resp:
+        if resp.status_code >= 400:
+            return _error_decision(resp.status_code)
+        async for line in resp.aiter_lines():
+            if not line:
+                continue
+            chunk = orjson.loads(line)
+            if "error" in chunk:
+                raise RuntimeError(f"Ollama error: {chunk['error']}")
+            piece = chunk.get("message", {}).get("content", "")
+            parts.append(piece)
+            if len(head) < _EARLY_WINDOW:
+                head += piece
+                if _EARLY_IGNORE.search(head):
+                    # Leaving the block closes the connection, which makes
+                    # Ollama stop generating.
+                    log.debug("  Ollama chose IGNORE after %d chars — stopping early", len(head))
+                    return dict(IGNORE_DECISION)
+
+    raw = "".join(parts)
+    log.debug("  Ollama responded (%d chars)", len(raw))
+    return _parse(raw)
+
+
+async def ask_ollama_batch(alerts: list[dict], target_os: str) -> list[dict]:
+    """Decide several same-OS alerts with one chat request.
+
+    Raises ValueError if the model does not return one decision per alert.
+    """
+    user_msg = orjson.dumps({"alerts": [_prompt_alert(a) for a in alerts], "target_os": target_os}).decode()
+    payload = _payload(BATCH_PROMPT, user_msg, stream=False, num_predict=2048 * len(alerts))
+
+    log.debug("  Ollama POST %s/api/chat  model=%s  batch=%d", OLLAMA_BASE_URL, OLLAMA_MODEL, len(alerts))
+
+    if _client is None:
+        await init_client()
+    resp = await _client.post("/api/chat", content=orjson.dumps(payload))
+    if resp.status_code >= 400:
+        error = _error_decision(resp.status_code)
+        return [dict(error) for _ in alerts]
+
+    raw = orjson.loads(await resp.aread()).get("message", {}).get("content", "")
+    log.debug("  Ollama responded (%d chars)", len(raw))
+    decisions = _parse(raw).get("decisions")
+    if not isinstance(decisions, list) or len(decisions) != len(alerts):
+        raise ValueError(f"expected {len(alerts)} decisions, got {decisions!r:.200}")
+    for d in decisions:
+        if not isinstance(d, dict) or not isinstance(d.get("action"), str):
+            raise ValueError(f"malformed decision in batch: {d!r:.200}")
+    return decisions
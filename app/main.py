@@ -1,62 +1,272 @@
 import asyncio
+import bisect
+import hashlib
+import itertools
 import logging
+import queue
+import re
+import secrets
+import socket
 import time
-import uuid
-from datetime import datetime, timezone
+from collections import defaultdict, deque
+from collections.abc import Mapping
+from dataclasses import dataclass
+from logging.handlers import QueueHandler, QueueListener
 
+import orjson
 import redis.asyncio as redis
-from fastapi import FastAPI
+from cachetools import TTLCache
+from fastapi import FastAPI, Query, Request
+from fastapi.exceptions import RequestValidationError
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel, Field
+from fastapi.responses import ORJSONResponse, Response, StreamingResponse
+from pydantic import BaseModel, ConfigDict, Field, TypeAdapter, ValidationError
+from rbloom import Bloom
+from redis.exceptions import ResponseError
 
-from .config import MIN_LEVEL, OLLAMA_BASE_URL, OLLAMA_MODEL, REDIS_URL, load_agents
-from .executor import run_ssh
-from .llm import ask_ollama
+from .config import (
+    AUDIT_LOG, AUDIT_SIZE, BATCH_SIZE, DEDUP_WINDOW, ENABLE_CORS,
+    LLM_BATCH_MAX, LLM_BATCH_WINDOW_MS, LLM_CACHE_TTL, LLM_LOCAL_CACHE_TTL,
+    LOG_LEVEL, LOG_QUEUE_SIZE, MIN_LEVEL,
+    OLLAMA_BASE_URL, OLLAMA_MODEL,
+    QUEUE_WORKERS, REDIS_URL, SSH_WORKERS,
+    AgentConfig, agents_mtime, load_agents, load_rule_table,
+)
+from .executor import close_connections, reap_idle_connections, run_ssh
+from .llm import ask_ollama, ask_ollama_batch, close_client, init_client
 
-logging.basicConfig(level=logging.INFO, format="%(asctime)s  %(levelname)-8s  %(message)s")
-log = logging.getLogger("soc")
 
-app = FastAPI(title="SOC Remediation", version="3.0.0")
-app.add_middleware(CORSMiddleware, allow_origins=["*"], allow_methods=["*"], allow_headers=["*"])
+class _DroppingQueueHandler(QueueHandler):
+    """Drops records instead of blocking the event loop when the queue is full."""
+
+    dropped = 0
 
-AGENTS: dict = {}
-AUDIT: list[dict] = []
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class _LogListener(QueueListener):
+    def enqueue_sentinel(self):
+        # The queue may be full at shutdown; wait for the thread to make room.
+        self.queue.put(self._sentinel)
+
+
+# Handlers only enqueue records; the listener thread does the stream writes.
+_log_queue: queue.Queue = queue.Queue(LOG_QUEUE_SIZE)
+_log_handler = _DroppingQueueHandler(_log_queue)
+_log_listener = _LogListener(_log_queue, logging.StreamHandler())
+logging.basicConfig(
+    level=LOG_LEVEL,
+    format="%(asctime)s  %(levelname)-8s  %(message)s",
+    handlers=[_log_handler],
+)
+log = logging.getLogger("soc")
+SEP = "=" * 60
+
+app = FastAPI(title="SOC Remediation", version="3.0.0", default_response_class=ORJSONResponse)
+# Wazuh posts server-to-server; CORS only matters for browser clients.
+if ENABLE_CORS:
+    app.add_middleware(CORSMiddleware, allow_origins=["*"], allow_methods=["*"], allow_headers=["*"])
+
+AGENTS: Mapping[str, AgentConfig] = {}
+AGENTS_POLL_INTERVAL = 5
+RULE_TABLE: Mapping[str, dict] = {}
+AUDIT: deque[dict] = deque(maxlen=AUDIT_SIZE)
+# Assigned right before AUDIT.append, so the deque is strictly ordered by it.
+_audit_seq = itertools.count(1)
+# Records waiting to be appended to AUDIT_LOG by _audit_flusher.
+AUDIT_QUEUE: asyncio.Queue[dict] = asyncio.Queue()
+AUDIT_FLUSH_INTERVAL = 1.0
+AUDIT_FLUSH_BATCH = 100
+_audit_task: asyncio.Task | None = None
 
 rdb: redis.Redis | None = None
-QUEUE_KEY = "soc:queue"
+STREAM_KEY = "soc:stream"
+GROUP = "workers"
+CLAIM_IDLE_MS = 600_000
+
+# Decided alerts waiting for SSH. Bounded so stream workers stop pulling
+# new alerts when remediation falls behind.
+SSH_QUEUE: asyncio.Queue["_Remediation"] = asyncio.Queue(maxsize=QUEUE_WORKERS * BATCH_SIZE)
+# Stream ids whose remediation is queued or running here. Their idle time is
+# reset periodically so no worker's XAUTOCLAIM runs them a second time.
+_held: set[str] = set()
+HELD_REFRESH_INTERVAL = CLAIM_IDLE_MS / 1000 / 4
+# A job can wait in SSH_QUEUE well past the usual 300s record TTL.
+EXECUTING_TTL = 3600
+
+# Random per-process prefix + counter: unique without an RNG call per job.
+_job_prefix = secrets.token_hex(2)
+_job_counter = itertools.count()
+
+# Alerts of similar severity get similar-length replies; batching within a
+# bin keeps a quick IGNORE from waiting behind a long remediation script.
+# Alerts below MIN_LEVEL never reach the LLM, so edges at or under it are dropped.
+LLM_BIN_EDGES = tuple(edge for edge in (7, 11) if edge > MIN_LEVEL)
+_llm_bins: list[asyncio.Queue[tuple[dict, str, asyncio.Future]]] = [
+    asyncio.Queue() for _ in range(len(LLM_BIN_EDGES) + 1)
+]
+_llm_bin_flushed = [0] * len(_llm_bins)
+_llm_pending = asyncio.Event()
 JOB_PREFIX = "soc:job:"
+DEDUP_PREFIX = "soc:dedup:"
+DEDUP_CAPACITY = 1_000_000
+DEDUP_ERROR_RATE = 0.001
+DEDUP_BLOOM = True
+DEDUP_CACHE_SIZE = 100_000
+# Keys remediated by this process; answers repeats without a Redis round-trip.
+DEDUP_CACHE: TTLCache = TTLCache(maxsize=DEDUP_CACHE_SIZE, ttl=max(1, DEDUP_WINDOW))
+# Most alerts are new: a miss here skips probing DEDUP_CACHE. Rebuilt from
+# the cache every window so expired keys fall out.
+DEDUP_LOCAL_BLOOM = Bloom(2 * DEDUP_CACHE_SIZE, DEDUP_ERROR_RATE)
+LLM_CACHE_PREFIX = "soc:llm:"
+# In-process front of the Redis decision cache, keyed the same way (alert
+# content hash). Scripts can name PIDs or paths from the alert, so a
+# decision is never shared between alerts that differ beyond volatile
+# fields. Only answers this process got from the LLM (and wrote to Redis)
+# are kept, for at most LLM_CACHE_TTL; Redis hits are not copied, since
+# their remaining TTL is unknown. DELETE /cache/llm clears Redis and the
+# replica serving it only; other replicas keep local copies until expiry.
+LLM_CACHE: TTLCache = TTLCache(maxsize=50_000, ttl=max(1, min(LLM_LOCAL_CACHE_TTL, LLM_CACHE_TTL)))
+LLM_CACHE_STATS = {"hits": 0, "misses": 0}
+
+# Values substituted into rule-table scripts come from the alert, so only
+# plain IPs, hostnames and account names are accepted.
+_PLACEHOLDER = re.compile(r"\{([\w.]+)\}")
+_SAFE_VALUE = re.compile(r"^[A-Za-z0-9][A-Za-z0-9._:@-]*$")
+
+# Timestamps and UUIDs differ between otherwise identical alerts; mask them
+# before hashing so repeats share a cached decision.
+_VOLATILE = re.compile(
+    r"\d{4}-\d{2}-\d{2}[T ]\d{2}:\d{2}:\d{2}(?:\.\d+)?(?:Z|[+-]\d{2}:?\d{2})?"
+    r"|\b[A-Z][a-z]{2} +\d{1,2} \d{2}:\d{2}:\d{2}\b"
+    r"|\b[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}\b",
+    re.IGNORECASE,
+)
 
 
 @app.on_event("startup")
 async def startup():
-    global AGENTS, rdb
-    AGENTS = load_agents()
+    global DEDUP_BLOOM, RULE_TABLE, _audit_task, rdb
+    _log_listener.start()
+    if hasattr(asyncio, "eager_task_factory"):  # Python 3.12+
+        asyncio.get_running_loop().set_task_factory(asyncio.eager_task_factory)
+    _set_agents(load_agents())
+    asyncio.create_task(_watch_agents())
+    RULE_TABLE = load_rule_table()
+    await init_client()
     rdb = redis.from_url(REDIS_URL, decode_responses=True)
     await rdb.ping()
     log.info("Redis connected: %s", REDIS_URL)
+    try:
+        await rdb.execute_command("BF.EXISTS", f"{DEDUP_PREFIX}probe", "")
+    except ResponseError:
+        DEDUP_BLOOM = False
+    if DEDUP_WINDOW > 0:
+        log.info("Dedup: %s, window %ds", "bloom filter" if DEDUP_BLOOM else "keyed", DEDUP_WINDOW)
+    else:
+        log.info("Dedup: disabled")
     log.info("Loaded %d agent(s): %s", len(AGENTS), list(AGENTS.keys()))
+    log.info("Loaded %d static rule(s): %s", len(RULE_TABLE), list(RULE_TABLE.keys()))
     log.info("Ollama: %s  model: %s", OLLAMA_BASE_URL, OLLAMA_MODEL)
     log.info("Min level: %d", MIN_LEVEL)
 
-    asyncio.create_task(_worker())
-    log.info("Queue worker started — processing 1 alert at a time")
+    try:
+        await rdb.xgroup_create(STREAM_KEY, GROUP, id="$", mkstream=True)
+    except ResponseError as e:
+        if "BUSYGROUP" not in str(e):
+            raise
+
+    asyncio.create_task(reap_idle_connections())
+    if DEDUP_WINDOW > 0:
+        asyncio.create_task(_rebuild_dedup_bloom())
+    if AUDIT_LOG:
+        _audit_task = asyncio.create_task(_audit_flusher())
+        log.info("Audit log: %s", AUDIT_LOG)
+    if LLM_BATCH_MAX > 1:
+        asyncio.create_task(_llm_batcher())
+        log.info("LLM micro-batching: up to %d alert(s) per %dms window", LLM_BATCH_MAX, LLM_BATCH_WINDOW_MS)
+
+    host = socket.gethostname()
+    for i in range(QUEUE_WORKERS):
+        asyncio.create_task(_worker(f"{host}-{i}"))
+    for _ in range(SSH_WORKERS):
+        asyncio.create_task(_ssh_worker())
+    asyncio.create_task(_refresh_held(f"{host}-ssh"))
+    log.info("Started %d queue worker(s) — up to %d alert(s) each", QUEUE_WORKERS, BATCH_SIZE)
+    log.info("Started %d SSH worker(s)", SSH_WORKERS)
+
+
+def _set_agents(agents: Mapping[str, AgentConfig]):
+    global AGENTS
+    AGENTS = agents
+
+
+async def _watch_agents():
+    mtime = agents_mtime()
+    while True:
+        await asyncio.sleep(AGENTS_POLL_INTERVAL)
+        current = agents_mtime()
+        if current == mtime:
+            continue
+        mtime = current
+        try:
+            _set_agents(load_agents())
+        except Exception as e:
+            log.error("Failed to reload agents: %s", e)
+            continue
+        log.info("Reloaded %d agent(s): %s", len(AGENTS), list(AGENTS.keys()))
 
 
 @app.on_event("shutdown")
 async def shutdown():
+    await close_client()
+    await close_connections()
     if rdb:
         await rdb.aclose()
+    if _audit_task is not None:
+        # Let the flusher write the batch it already took off the queue.
+        _audit_task.cancel()
+        for res in await asyncio.gather(_audit_task, return_exceptions=True):
+            if isinstance(res, OSError):
+                log.error("[AUDIT] Failed to write final batch to %s: %s", AUDIT_LOG, res)
+    if AUDIT_LOG and not AUDIT_QUEUE.empty():
+        _write_audit([AUDIT_QUEUE.get_nowait() for _ in range(AUDIT_QUEUE.qsize())])
+    _log_listener.stop()
+
+
+_ts_second = -1
+_ts_prefix = ""
+
+
+def _utc_now() -> str:
+    """ISO-8601 UTC timestamp to the millisecond; strftime runs once per second."""
+    global _ts_second, _ts_prefix
+    t = time.time()
+    second = int(t)
+    if second != _ts_second:
+        _ts_second, _ts_prefix = second, time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(second))
+    return f"{_ts_prefix}.{int((t - second) * 1000):03d}Z"
 
 
 class AlertRule(BaseModel):
+    model_config = ConfigDict(extra="ignore", frozen=True)
+
     id: str = ""
     level: int = 0
     description: str = ""
 
 class AlertAgent(BaseModel):
+    model_config = ConfigDict(extra="ignore", frozen=True)
+
     name: str = ""
 
 class WazuhAlert(BaseModel):
+    model_config = ConfigDict(extra="ignore", frozen=True)
+
     timestamp: str = ""
     rule: AlertRule = Field(default_factory=AlertRule)
     agent: AlertAgent = Field(default_factory=AlertAgent)
@@ -64,9 +274,210 @@ class WazuhAlert(BaseModel):
     full_log: str = ""
 
 
+# Built once; webhooks validate the raw body bytes directly.
+_ALERT = TypeAdapter(WazuhAlert)
+_ALERT_LIST = TypeAdapter(list[WazuhAlert])
+
+
+def _validate(adapter: TypeAdapter, raw: bytes):
+    try:
+        return adapter.validate_json(raw)
+    except ValidationError as e:
+        raise RequestValidationError(e.errors(include_url=False))
+
+
+DedupKey = tuple[str, str, str, str]
+
+
+def _dedup_key(agent_name: str, rule_id: str, data: dict) -> DedupKey:
+    # A tuple hashes cheaper than a joined string and is only joined for Redis.
+    # Fields may come from an unvalidated body (_peek), so coerce them all.
+    user = data.get("dstuser") or data.get("srcuser", "")
+    return str(agent_name), str(rule_id), str(data.get("srcip", "")), str(user)
+
+
+def _dedup_filters() -> tuple[str, str]:
+    # Bloom filters have no per-item TTL, so rotate one filter per window
+    # and check the current and previous ones.
+    epoch = int(time.time()) // DEDUP_WINDOW
+    return f"{DEDUP_PREFIX}{epoch}", f"{DEDUP_PREFIX}{epoch - 1}"
+
+
+async def _is_duplicate(key: DedupKey) -> bool:
+    if DEDUP_WINDOW <= 0:
+        return False
+    if key in DEDUP_LOCAL_BLOOM and key in DEDUP_CACHE:
+        return True
+    item = "|".join(key)
+    if not DEDUP_BLOOM:
+        return bool(await rdb.exists(f"{DEDUP_PREFIX}key:{item}"))
+    async with rdb.pipeline(transaction=False) as pipe:
+        for name in _dedup_filters():
+            pipe.execute_command("BF.EXISTS", name, item)
+        return any(await pipe.execute())
+
+
+async def _mark_seen(key: DedupKey):
+    if DEDUP_WINDOW <= 0:
+        return
+    DEDUP_CACHE[key] = True
+    DEDUP_LOCAL_BLOOM.add(key)
+    item = "|".join(key)
+    if not DEDUP_BLOOM:
+        await rdb.setex(f"{DEDUP_PREFIX}key:{item}", DEDUP_WINDOW, 1)
+        return
+    current, _ = _dedup_filters()
+    async with rdb.pipeline(transaction=False) as pipe:
+        pipe.execute_command(
+            "BF.INSERT", current, "CAPACITY", DEDUP_CAPACITY, "ERROR", DEDUP_ERROR_RATE,
+            "EXPANSION", 2, "ITEMS", item,
+        )
+        pipe.expire(current, 2 * DEDUP_WINDOW)
+        await pipe.execute()
+
+
+async def _rebuild_dedup_bloom():
+    global DEDUP_LOCAL_BLOOM
+    while True:
+        await asyncio.sleep(DEDUP_WINDOW)
+        DEDUP_CACHE.expire()
+        bloom = Bloom(2 * DEDUP_CACHE_SIZE, DEDUP_ERROR_RATE)
+        bloom.update(DEDUP_CACHE.keys())
+        DEDUP_LOCAL_BLOOM = bloom
+
+
+def _render(template: str, data: dict) -> str | None:
+    unsafe = False
+
+    def lookup(match: re.Match) -> str:
+        nonlocal unsafe
+        value = data
+        for part in match.group(1).split("."):
+            value = value.get(part, "") if isinstance(value, dict) else ""
+        value = str(value)
+        if not _SAFE_VALUE.match(value):
+            unsafe = True
+        return value
+
+    rendered = _PLACEHOLDER.sub(lookup, template)
+    return None if unsafe else rendered
+
+
+def _rule_decision(rule_id: str, data: dict, target_os: str) -> dict | None:
+    entry = RULE_TABLE.get(rule_id)
+    if not entry or target_os not in entry.get("scripts", {}):
+        return None
+    script = _render(entry["scripts"][target_os], data)
+    if script is None:
+        return None
+    return {
+        "action": entry["action"],
+        "severity": entry.get("severity", "high"),
+        "summary": _render(entry.get("summary", ""), data) or entry.get("summary", ""),
+        "reason": f"Static rule table entry for rule {rule_id}.",
+        "script": script,
+    }
+
+
+def _decision_key(alert: dict, target_os: str) -> str:
+    canonical = {k: v for k, v in alert.items() if k != "timestamp"}
+    canonical["full_log"] = _VOLATILE.sub("", canonical.get("full_log", ""))
+    digest = hashlib.sha256(
+        orjson.dumps({"alert": canonical, "target_os": target_os}, option=orjson.OPT_SORT_KEYS)
+    ).hexdigest()
+    return f"{LLM_CACHE_PREFIX}{digest}"
+
+
+async def _ask_llm(alert: dict, target_os: str) -> dict:
+    if LLM_BATCH_MAX <= 1:
+        return await ask_ollama(alert, target_os)
+    fut = asyncio.get_running_loop().create_future()
+    level = alert.get("rule", {}).get("level", 0)
+    _llm_bins[bisect.bisect_right(LLM_BIN_EDGES, level)].put_nowait((alert, target_os, fut))
+    _llm_pending.set()
+    return await fut
+
+
+def _llm_bin_stats() -> list[dict]:
+    bounds = (MIN_LEVEL, *LLM_BIN_EDGES, None)
+    return [
+        {
+            "levels": f"{lo}+" if hi is None else f"{lo}-{hi - 1}",
+            "queued": q.qsize(),
+            "batches": flushed,
+        }
+        for lo, hi, q, flushed in zip(bounds, bounds[1:], _llm_bins, _llm_bin_flushed)
+    ]
+
+
+async def _llm_batcher():
+    while True:
+        await _llm_pending.wait()
+        if max(q.qsize() for q in _llm_bins) < LLM_BATCH_MAX:
+            await asyncio.sleep(LLM_BATCH_WINDOW_MS / 1000)
+        idx = max(range(len(_llm_bins)), key=lambda i: _llm_bins[i].qsize())
+        fullest = _llm_bins[idx]
+        items = [fullest.get_nowait() for _ in range(min(LLM_BATCH_MAX, fullest.qsize()))]
+        _llm_bin_flushed[idx] += 1
+        if all(q.empty() for q in _llm_bins):
+            _llm_pending.clear()
+        by_os: dict[str, list] = defaultdict(list)
+        for item in items:
+            by_os[item[1]].append(item)
+        for target_os, group in by_os.items():
+            asyncio.create_task(_flush_llm_batch(target_os, group))
+
+
+async def _flush_llm_batch(target_os: str, group: list[tuple[dict, str, asyncio.Future]]):
+    alerts = [alert for alert, _, _ in group]
+    results: list = []
+    if len(alerts) > 1:
+        try:
+            results = await ask_ollama_batch(alerts, target_os)
+        except Exception as e:
+            log.warning("  Batched Ollama call failed (%s) — asking per alert", e)
+    if not results:
+        results = await asyncio.gather(*(ask_ollama(a, target_os) for a in alerts), return_exceptions=True)
+    for (_, _, fut), res in zip(group, results):
+        if fut.done():
+            continue
+        if isinstance(res, Exception):
+            fut.set_exception(res)
+        else:
+            fut.set_result(res)
+
+
+async def _decide(alert: dict, target_os: str) -> dict:
+    if LLM_CACHE_TTL <= 0:
+        return await _ask_llm(alert, target_os)
+    key = _decision_key(alert, target_os)
+    local = LLM_LOCAL_CACHE_TTL > 0
+    if local:
+        decision = LLM_CACHE.get(key)
+        if decision is not None:
+            LLM_CACHE_STATS["hits"] += 1
+            return dict(decision)
+        LLM_CACHE_STATS["misses"] += 1
+
+    cached = await rdb.get(key)
+    if cached:
+        log.debug("  LLM cache hit (%s)", key[len(LLM_CACHE_PREFIX):][:12])
+        decision = orjson.loads(cached)
+    else:
+        decision = await _ask_llm(alert, target_os)
+        if not isinstance(decision, dict):
+            raise ValueError(f"LLM decision is not an object: {decision!r:.200}")
+        if "llm_error" in decision:
+            return decision
+        await rdb.setex(key, LLM_CACHE_TTL, orjson.dumps(decision))
+        if local:
+            LLM_CACHE[key] = dict(decision)
+    return decision
+
+
 @app.get("/health")
 async def health():
-    queue_len = await rdb.llen(QUEUE_KEY) if rdb else 0
+    queue_len = await rdb.xlen(STREAM_KEY) if rdb else 0
     return {
         "status": "ok",
         "ollama": OLLAMA_BASE_URL,
@@ -75,32 +486,93 @@ async def health():
         "redis": REDIS_URL,
         "queue_length": queue_len,
         "min_level": MIN_LEVEL,
+        "llm_bins": _llm_bin_stats(),
+        "log_dropped": _log_handler.dropped,
+        "llm_cache": {"size": len(LLM_CACHE), **LLM_CACHE_STATS},
     }
 
 
-@app.post("/webhook")
-async def webhook(alert: WazuhAlert):
-    agent_name = alert.agent.name
+def _filtered(level: int, description: str) -> dict:
+    log.info("[FILTERED] Level %d < %d — %s. IGNORE.", level, MIN_LEVEL, description)
+    return {
+        "status": "filtered",
+        "reason": f"Level {level} below threshold ({MIN_LEVEL}).",
+    }
+
+
+def _duplicate(key: DedupKey) -> dict:
+    log.info("[DUPLICATE] Rule [%s] on '%s' already remediated within %ds.", key[1], key[0], DEDUP_WINDOW)
+    return {
+        "status": "duplicate",
+        "reason": f"Same alert remediated within the last {DEDUP_WINDOW}s.",
+    }
 
+
+async def _screen(alert: WazuhAlert) -> dict | None:
+    """Return the response for an alert that should not be queued, else None."""
     if alert.rule.level < MIN_LEVEL:
-        log.info("[FILTERED] Level %d < %d — %s. IGNORE.", alert.rule.level, MIN_LEVEL, alert.rule.description)
-        return {
-            "status": "filtered",
-            "reason": f"Level {alert.rule.level} below threshold ({MIN_LEVEL}).",
-        }
+        return _filtered(alert.rule.level, alert.rule.description)
+    key = _dedup_key(alert.agent.name, alert.rule.id, alert.data)
+    if await _is_duplicate(key):
+        return _duplicate(key)
+    return None
+
+
+def _peek(raw: bytes) -> tuple[dict, DedupKey] | None:
+    """Read rule and dedup key straight from the JSON body, before validation.
+
+    Returns None when the body is not shaped like an alert; validation
+    then produces the error.
+    """
+    try:
+        head = orjson.loads(raw)
+        rule = head.get("rule", {})
+        return rule, _dedup_key(head.get("agent", {}).get("name", ""), rule.get("id", ""), head.get("data", {}))
+    except (orjson.JSONDecodeError, AttributeError):
+        return None
 
-    job_id = str(uuid.uuid4())[:8]
+
+def _enqueue(pipe, alert: WazuhAlert) -> str:
+    job_id = f"{_job_prefix}{next(_job_counter):06x}"
+    queued_at = _utc_now()
     job_data = {
         "job_id": job_id,
-        "alert": alert.model_dump(),
+        # Serialized by pydantic-core straight to JSON; no intermediate dict.
+        "alert": orjson.Fragment(alert.model_dump_json()),
         "status": "queued",
-        "queued_at": datetime.now(timezone.utc).isoformat(),
+        "queued_at": queued_at,
     }
+    pipe.xadd(STREAM_KEY, {"data": orjson.dumps(job_data)})
+    pipe.setex(f"{JOB_PREFIX}{job_id}", 300, orjson.dumps({"status": "queued", "queued_at": queued_at}))
+    return job_id
+
 
-    import json
-    await rdb.rpush(QUEUE_KEY, json.dumps(job_data))
-    await rdb.setex(f"{JOB_PREFIX}{job_id}", 300, json.dumps({"status": "queued", "queued_at": job_data["queued_at"]}))
-    queue_len = await rdb.llen(QUEUE_KEY)
+@app.post("/webhook")
+async def webhook(request: Request):
+    raw = await request.body()
+    # Filtered and duplicate alerts (scanner floods, chatty agents) are
+    # answered without paying for full validation.
+    peeked = _peek(raw)
+    if peeked is not None:
+        rule, key = peeked
+        level = rule.get("level")
+        if type(level) is int and level < MIN_LEVEL:
+            return _filtered(level, rule.get("description", ""))
+        if await _is_duplicate(key):
+            return _duplicate(key)
+
+    alert: WazuhAlert = _validate(_ALERT, raw)
+    if alert.rule.level < MIN_LEVEL:
+        return _filtered(alert.rule.level, alert.rule.description)
+    if peeked is None:
+        key = _dedup_key(alert.agent.name, alert.rule.id, alert.data)
+        if await _is_duplicate(key):
+            return _duplicate(key)
+
+    async with rdb.pipeline(transaction=False) as pipe:
+        job_id = _enqueue(pipe, alert)
+        pipe.xlen(STREAM_KEY)
+        *_, queue_len = await pipe.execute()
 
     log.info("[QUEUED] job=%s  Rule [%s] %s → position %d", job_id, alert.rule.id, alert.rule.description, queue_len)
 
@@ -108,133 +580,326 @@ async def webhook(alert: WazuhAlert):
         "status": "queued",
         "job_id": job_id,
         "queue_position": queue_len,
-        "agent": agent_name,
+        "agent": alert.agent.name,
         "rule": alert.rule.description,
     }
 
 
+@app.post("/webhook/batch")
+async def webhook_batch(request: Request):
+    """Queue several alerts with one Redis round-trip; workers decide them concurrently."""
+    alerts: list[WazuhAlert] = _validate(_ALERT_LIST, await request.body())
+    results = list(await asyncio.gather(*(_screen(a) for a in alerts)))
+    queued = [i for i, res in enumerate(results) if res is None]
+    if not queued:
+        return {"queued": 0, "results": results}
+
+    async with rdb.pipeline(transaction=False) as pipe:
+        job_ids = [_enqueue(pipe, alerts[i]) for i in queued]
+        pipe.xlen(STREAM_KEY)
+        *_, queue_len = await pipe.execute()
+
+    for i, job_id in zip(queued, job_ids):
+        alert = alerts[i]
+        results[i] = {
+            "status": "queued",
+            "job_id": job_id,
+            "agent": alert.agent.name,
+            "rule": alert.rule.description,
+        }
+    log.info("[QUEUED] %d of %d alert(s) from batch → queue length %d", len(queued), len(alerts), queue_len)
+    return {"queued": len(queued), "queue_length": queue_len, "results": results}
+
+
 @app.get("/job/{job_id}")
+@app.get("/jobs/{job_id}")
 async def get_job(job_id: str):
-    import json
     raw = await rdb.get(f"{JOB_PREFIX}{job_id}")
     if not raw:
         return {"error": f"Job {job_id} not found or expired."}
-    return json.loads(raw)
+    # Stored as JSON already; hand it back without a decode/encode round-trip.
+    return Response(raw, media_type="application/json")
+
+
+@dataclass(slots=True)
+class _Remediation:
+    """A decided alert waiting for an SSH worker."""
+
+    job_id: str
+    msg_id: str | None
+    agent_name: str
+    agent: AgentConfig
+    rule: dict
+    data: dict
+    action: str
+    script: str
+    start: float
+
 
+async def _process_alert(raw: str, msg_id: str | None = None) -> bool:
+    """Decide one queued alert.
 
-async def _process_alert(raw: str):
-    import json
-    job_data = json.loads(raw)
+    Returns True if it was handed to an SSH worker, which then acknowledges
+    *msg_id* once the script has run.
+    """
+    # The alert was validated and dumped by /webhook; use the dict as-is.
+    job_data = orjson.loads(raw)
     job_id = job_data["job_id"]
-    alert = WazuhAlert.model_validate(job_data["alert"])
-    agent_name = alert.agent.name
+    alert = job_data["alert"]
+    rule = alert["rule"]
+    agent_name = alert["agent"]["name"]
     agent = AGENTS.get(agent_name)
-    target_os = agent.get("os", "ubuntu") if agent else "ubuntu"
+    target_os = agent.os if agent else "ubuntu"
     start = time.time()
-
-    await rdb.setex(f"{JOB_PREFIX}{job_id}", 300, json.dumps({"status": "processing", "started_at": datetime.now(timezone.utc).isoformat()}))
-
-    log.info("=" * 60)
-    log.info("[STEP 1] job=%s  PROCESSING ALERT", job_id)
-    log.info("  Agent: '%s'  OS: %s", agent_name, target_os)
-    if agent:
-        log.info("  Agent FOUND → %s@%s", agent["username"], agent["host"])
-    else:
+    started_at = _utc_now()
+
+    await rdb.setex(f"{JOB_PREFIX}{job_id}", 300, orjson.dumps({"status": "processing", "started_at": started_at}))
+
+    # Per-step detail is DEBUG only; the [DONE] line is the INFO summary.
+    debug = log.isEnabledFor(logging.DEBUG)
+    if debug:
+        log.debug(SEP)
+        log.debug("[STEP 1] job=%s  PROCESSING ALERT", job_id)
+        log.debug("  Agent: '%s'  OS: %s", agent_name, target_os)
+        if agent:
+            log.debug("  Agent FOUND → %s@%s", agent.username, agent.host)
+        log.debug("  Rule: [%s] %s (level %d)", rule["id"], rule["description"], rule["level"])
+        log.debug("  Log: %s", alert["full_log"][:200])
+    if not agent:
         log.warning("  Agent '%s' NOT FOUND. Available: %s", agent_name, list(AGENTS.keys()))
-    log.info("  Rule: [%s] %s (level %d)", alert.rule.id, alert.rule.description, alert.rule.level)
-    log.info("  Log: %s", alert.full_log[:200])
 
-    log.info("[STEP 2] job=%s  SENDING TO OLLAMA (%s)...", job_id, OLLAMA_MODEL)
-    try:
-        decision = await ask_ollama(alert.model_dump(), target_os)
-    except Exception as e:
-        log.error("[STEP 2] job=%s  OLLAMA FAILED: %s", job_id, e)
-        decision = {
-            "action": "IGNORE",
-            "severity": "low",
-            "summary": f"LLM error: {e}",
-            "reason": "Ollama unavailable, defaulting to IGNORE.",
-            "script": "",
-        }
+    decision = _rule_decision(rule["id"], alert["data"], target_os)
+    if decision is not None:
+        log.debug("[STEP 2] job=%s  STATIC RULE %s — skipping Ollama", job_id, rule["id"])
+    else:
+        log.debug("[STEP 2] job=%s  SENDING TO OLLAMA (%s)...", job_id, OLLAMA_MODEL)
+        try:
+            decision = await _decide(alert, target_os)
+        except Exception as e:
+            log.error("[STEP 2] job=%s  OLLAMA FAILED: %s", job_id, e)
+            decision = {
+                "action": "IGNORE",
+                "severity": "low",
+                "summary": f"LLM error: {e}",
+                "reason": "Ollama unavailable, defaulting to IGNORE.",
+                "script": "",
+            }
 
     action = decision.get("action", "IGNORE")
     script = decision.get("script", "")
 
-    log.info("[STEP 3] job=%s  AI DECISION", job_id)
-    log.info("  Action:   %s", action)
-    log.info("  Severity: %s", decision.get("severity", "?"))
-    log.info("  Summary:  %s", decision.get("summary", "?"))
-    log.info("  Reason:   %s", decision.get("reason", "?"))
-    if script:
-        log.info("  Script:   %s", script[:200])
-
-    executed = False
-    output = ""
-    error = ""
+    if debug:
+        log.debug("[STEP 3] job=%s  AI DECISION", job_id)
+        log.debug("  Action:   %s", action)
+        log.debug("  Severity: %s", decision.get("severity", "?"))
+        log.debug("  Summary:  %s", decision.get("summary", "?"))
+        log.debug("  Reason:   %s", decision.get("reason", "?"))
+        if script:
+            log.debug("  Script:   %s", script[:200])
 
     if action != "IGNORE" and script and agent:
-        log.info("[STEP 4] job=%s  EXECUTING via SSH on %s (%s)...", job_id, agent_name, agent["host"])
-        result = await run_ssh(
-            host=agent["host"],
-            port=agent.get("port", 22),
-            username=agent["username"],
-            script=script,
-            password=agent.get("password"),
-            key_file=agent.get("key_file"),
-            target_os=target_os,
+        await rdb.setex(
+            f"{JOB_PREFIX}{job_id}", EXECUTING_TTL,
+            orjson.dumps({"status": "executing", "action": action, "started_at": started_at}),
         )
-        executed = True
-        output = result.get("output", "")
-        error = result.get("error", "")
-
-        if result["success"]:
-            log.info("[STEP 5] job=%s  EXECUTION SUCCESS", job_id)
-            log.info("  Output: %s", output[:300])
-        else:
-            log.error("[STEP 5] job=%s  EXECUTION FAILED", job_id)
-            log.error("  Error: %s", error[:300])
-    elif action != "IGNORE" and not agent:
+        if msg_id is not None:
+            _held.add(msg_id)
+        await SSH_QUEUE.put(_Remediation(
+            job_id, msg_id, agent_name, agent, rule, alert["data"], action, script, start,
+        ))
+        return True
+    if action != "IGNORE" and not agent:
         log.warning("[STEP 4] job=%s  SKIPPED — agent '%s' not in inventory", job_id, agent_name)
     else:
-        log.info("[STEP 4] job=%s  SKIPPED — action is IGNORE", job_id)
+        log.debug("[STEP 4] job=%s  SKIPPED — action is IGNORE", job_id)
+    await _finish(job_id, agent_name, rule, action, start)
+    return False
+
+
+async def _execute(job: _Remediation):
+    agent = job.agent
+    log.debug("[STEP 4] job=%s  EXECUTING via SSH on %s (%s)...", job.job_id, job.agent_name, agent.host)
+    result = await run_ssh(
+        host=agent.host,
+        port=agent.port,
+        username=agent.username,
+        script=job.script,
+        password=agent.password,
+        key_file=agent.key_file,
+        target_os=agent.os,
+    )
+    output = result.get("output", "")
+    error = result.get("error", "")
+
+    if result["success"]:
+        await _mark_seen(_dedup_key(job.agent_name, job.rule["id"], job.data))
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("[STEP 5] job=%s  EXECUTION SUCCESS", job.job_id)
+            log.debug("  Output: %s", output[:300])
+    else:
+        log.error("[STEP 5] job=%s  EXECUTION FAILED", job.job_id)
+        log.error("  Error: %s", error[:300])
+    await _finish(job.job_id, job.agent_name, job.rule, job.action, job.start, True, output, error)
+
 
+async def _finish(
+    job_id: str, agent_name: str, rule: dict, action: str, start: float,
+    executed: bool = False, output: str = "", error: str = "",
+):
     elapsed = round(time.time() - start, 2)
 
     job_result = {
         "status": "completed",
         "job_id": job_id,
         "agent": agent_name,
-        "rule": alert.rule.description,
-        "level": alert.rule.level,
+        "rule": rule["description"],
+        "level": rule["level"],
         "action": action,
         "executed": executed,
         "output": output[:500],
         "error": error[:500],
         "elapsed_seconds": elapsed,
-        "completed_at": datetime.now(timezone.utc).isoformat(),
+        "completed_at": _utc_now(),
     }
-    await rdb.setex(f"{JOB_PREFIX}{job_id}", 300, json.dumps(job_result))
+    await rdb.setex(f"{JOB_PREFIX}{job_id}", 300, orjson.dumps(job_result))
 
+    job_result["seq"] = next(_audit_seq)
     AUDIT.append(job_result)
-    if len(AUDIT) > 200:
-        AUDIT[:] = AUDIT[-200:]
+    if AUDIT_LOG:
+        AUDIT_QUEUE.put_nowait(job_result)
+
+    log.info(
+        "[DONE] job=%s  agent=%s  rule=%s  action=%s  executed=%s  took=%.2fs",
+        job_id, agent_name, rule["id"], action, executed, elapsed,
+    )
+    log.debug(SEP)
+
+
+def _write_audit(records: list[dict]):
+    with open(AUDIT_LOG, "ab") as f:
+        f.write(b"".join(orjson.dumps(r, option=orjson.OPT_APPEND_NEWLINE) for r in records))
+
 
-    log.info("[DONE] job=%s  action=%s  executed=%s  agent=%s  took=%.2fs", job_id, action, executed, agent_name, elapsed)
-    log.info("=" * 60)
+async def _audit_flusher():
+    loop = asyncio.get_running_loop()
+    batch: list[dict] = []
+    try:
+        while True:
+            batch.append(await AUDIT_QUEUE.get())
+            deadline = loop.time() + AUDIT_FLUSH_INTERVAL
+            while len(batch) < AUDIT_FLUSH_BATCH:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(AUDIT_QUEUE.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            pending, batch = batch, []
+            write = asyncio.ensure_future(asyncio.to_thread(_write_audit, pending))
+            try:
+                # Shielded so a cancel at shutdown waits for this write
+                # instead of abandoning it mid-flight.
+                await asyncio.shield(write)
+            except asyncio.CancelledError:
+                await write
+                raise
+            except OSError as e:
+                log.error("[AUDIT] Failed to write %d record(s) to %s: %s", len(pending), AUDIT_LOG, e)
+    finally:
+        # Records taken off the queue but not yet handed to a write.
+        if batch:
+            _write_audit(batch)
+
+
+async def _next_batch(consumer: str, reclaim: bool = False) -> list[tuple[str, dict]]:
+    if reclaim:
+        # Entries delivered to a consumer that died before XACK stay pending;
+        # take them over once they have been idle long enough.
+        claimed = await rdb.xautoclaim(STREAM_KEY, GROUP, consumer, CLAIM_IDLE_MS, count=BATCH_SIZE)
+        # Entries still queued for SSH here are not stale, just waiting.
+        entries = [(msg_id, fields) for msg_id, fields in claimed[1] if fields and msg_id not in _held]
+        if entries:
+            log.warning("[WORKER %s] Reclaimed %d stale job(s)", consumer, len(entries))
+            return entries
+    resp = await rdb.xreadgroup(GROUP, consumer, {STREAM_KEY: ">"}, count=BATCH_SIZE, block=1000)
+    if not resp:
+        return []
+    _, entries = resp[0]
+    return entries
+
+
+async def _ack(ids: list[str]):
+    async with rdb.pipeline(transaction=False) as pipe:
+        pipe.xack(STREAM_KEY, GROUP, *ids)
+        pipe.xdel(STREAM_KEY, *ids)
+        await pipe.execute()
+
+
+async def _ssh_worker():
+    while True:
+        job = await SSH_QUEUE.get()
+        try:
+            await _execute(job)
+        except Exception as e:
+            log.error("[SSH] job=%s  failed: %s", job.job_id, e)
+        if job.msg_id is None:
+            continue
+        try:
+            await _ack([job.msg_id])
+        except Exception as e:
+            log.error("[SSH] job=%s  ack failed: %s", job.job_id, e)
+        finally:
+            _held.discard(job.msg_id)
 
 
-async def _worker():
-    log.info("[WORKER] Waiting for alerts...")
+async def _refresh_held(consumer: str):
     while True:
+        await asyncio.sleep(HELD_REFRESH_INTERVAL)
+        if not _held:
+            continue
         try:
-            item = await rdb.blpop(QUEUE_KEY, timeout=1)
-            if item:
-                _, raw = item
-                queue_len = await rdb.llen(QUEUE_KEY)
-                log.info("[WORKER] Picked up job (%d remaining in queue)", queue_len)
-                await _process_alert(raw)
+            # JUSTID claim with no minimum idle time just resets the idle clock.
+            await rdb.xclaim(STREAM_KEY, GROUP, consumer, 0, list(_held), justid=True)
         except Exception as e:
-            log.error("[WORKER] Error: %s", e)
+            log.error("[SSH] Failed to refresh %d held job(s): %s", len(_held), e)
+
+
+async def _worker(consumer: str):
+    log.info("[WORKER %s] Waiting for alerts...", consumer)
+    next_reclaim = 0.0
+
+    def fetch() -> asyncio.Task:
+        nonlocal next_reclaim
+        reclaim = time.monotonic() >= next_reclaim
+        if reclaim:
+            next_reclaim = time.monotonic() + CLAIM_IDLE_MS / 1000
+        return asyncio.create_task(_next_batch(consumer, reclaim))
+
+    prefetch: asyncio.Task | None = None
+    while True:
+        try:
+            task, prefetch = prefetch or fetch(), None
+            batch = await task
+            if not batch:
+                continue
+            log.debug("[WORKER %s] Picked up %d job(s)", consumer, len(batch))
+            # Read the next batch while this one waits on Ollama.
+            prefetch = fetch()
+            results = await asyncio.gather(
+                *(_process_alert(fields["data"], msg_id) for msg_id, fields in batch), return_exceptions=True,
+            )
+            for res in results:
+                if isinstance(res, Exception):
+                    log.error("[WORKER %s] Job failed: %s", consumer, res)
+            # Jobs handed to an SSH worker are acked there, after the script
+            # runs. Failed jobs are acked too: redelivering them would just
+            # fail again.
+            ids = [msg_id for (msg_id, _), res in zip(batch, results) if res is not True]
+            if ids:
+                await _ack(ids)
+        except Exception as e:
+            log.error("[WORKER %s] Error: %s", consumer, e)
             await asyncio.sleep(2)
 
 
@@ -242,19 +907,60 @@ async def _worker():
 async def analyze_only(alert: WazuhAlert):
     log.info("[DRY RUN] Rule: %s (level %d)", alert.rule.description, alert.rule.level)
     agent = AGENTS.get(alert.agent.name)
-    target_os = agent.get("os", "ubuntu") if agent else "ubuntu"
+    target_os = agent.os if agent else "ubuntu"
     try:
         return await ask_ollama(alert.model_dump(), target_os)
     except Exception as e:
         return {"action": "IGNORE", "summary": f"LLM error: {e}", "script": ""}
 
 
+AUDIT_CHUNK = 100
+
+
 @app.get("/audit")
-async def audit():
-    return list(reversed(AUDIT))
+async def audit(limit: int = Query(200, ge=1, le=AUDIT_SIZE), before: int | None = None):
+    """Newest-first NDJSON; pass the last record's ``seq`` as ``before`` for the next page."""
+    newest = reversed(AUDIT)
+    if before is not None:
+        newest = itertools.dropwhile(lambda r: r["seq"] >= before, newest)
+    # Take the references now: workers keep appending while the body streams.
+    records = list(itertools.islice(newest, limit))
+
+    async def lines():
+        for i in range(0, len(records), AUDIT_CHUNK):
+            yield b"".join(
+                orjson.dumps(r, option=orjson.OPT_APPEND_NEWLINE) for r in records[i:i + AUDIT_CHUNK]
+            )
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
+
+
+@app.delete("/cache/llm")
+async def clear_llm_cache():
+    """Drop cached LLM decisions, e.g. after changing the model or prompt."""
+    local = len(LLM_CACHE)
+    LLM_CACHE.clear()
+    shared = 0
+    batch: list[str] = []
+    async for key in rdb.scan_iter(match=f"{LLM_CACHE_PREFIX}*", count=1000):
+        batch.append(key)
+        if len(batch) >= 1000:
+            shared += await rdb.unlink(*batch)
+            batch.clear()
+    if batch:
+        shared += await rdb.unlink(*batch)
+    log.info("[CACHE] Cleared %d local and %d shared LLM decision(s)", local, shared)
+    return {"local": local, "shared": shared}
 
 
 @app.get("/queue")
 async def queue_status():
-    queue_len = await rdb.llen(QUEUE_KEY) if rdb else 0
+    queue_len = await rdb.xlen(STREAM_KEY) if rdb else 0
     return {"queue_length": queue_len}
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    # "auto" picks uvloop and httptools when installed (not on Windows).
+    uvicorn.run(app, host="0.0.0.0", port=8000, loop="auto", http="auto")
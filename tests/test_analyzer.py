@@ -1,16 +1,21 @@
+import asyncio
 import json
+from contextlib import ExitStack
 from unittest.mock import AsyncMock, MagicMock, patch
 
+import asyncssh
 import pytest
 from fastapi.testclient import TestClient
 
-from app.llm import ask_ollama
+from app.llm import ask_ollama, ask_ollama_batch
+from app import executor, llm
+from app.config import AgentConfig
 from app.executor import run_ssh
 
 
 AGENTS = {
-    "ubuntu-host": {"host": "10.0.0.1", "port": 22, "username": "admin", "password": "x", "os": "ubuntu"},
-    "win-host": {"host": "10.0.0.2", "port": 22, "username": "Admin", "password": "x", "os": "windows"},
+    "ubuntu-host": AgentConfig(host="10.0.0.1", username="admin", password="x"),
+    "win-host": AgentConfig(host="10.0.0.2", username="Admin", password="x", os="windows"),
 }
 
 
@@ -24,31 +29,157 @@ def _ollama_response(action, script="echo ok", severity="high"):
     })
 
 
+def _redis(*results):
+    """AsyncMock Redis client whose pipelines return *results* in order."""
+    pipe = MagicMock()
+    pipe.__aenter__ = AsyncMock(return_value=pipe)
+    pipe.__aexit__ = AsyncMock(return_value=False)
+    pipe.execute = AsyncMock(side_effect=list(results) or None, return_value=[])
+    rdb = AsyncMock()
+    rdb.get.return_value = None
+    rdb.pipeline = MagicMock(return_value=pipe)
+    return rdb
+
+
+def _bloom():
+    """Patch in an empty local dedup bloom so keys don't leak between tests."""
+    import app.main as m
+    return patch("app.main.DEDUP_LOCAL_BLOOM", m.Bloom(2 * m.DEDUP_CACHE_SIZE, m.DEDUP_ERROR_RATE))
+
+
+def _ollama_stream(content, size=8, status_code=200):
+    """Mock httpx client whose stream() replays *content* as Ollama chat chunks."""
+    client = MagicMock()
+    client.lines = [
+        json.dumps({"message": {"content": content[i:i + size]}, "done": False})
+        for i in range(0, len(content), size)
+    ] + [json.dumps({"message": {"content": ""}, "done": True})]
+    client.lines_read = 0
+
+    async def aiter_lines():
+        for line in client.lines:
+            client.lines_read += 1
+            yield line
+
+    resp = MagicMock(status_code=status_code)
+    resp.aiter_lines = aiter_lines
+    stream = MagicMock()
+    stream.__aenter__ = AsyncMock(return_value=resp)
+    stream.__aexit__ = AsyncMock(return_value=False)
+    client.stream = MagicMock(return_value=stream)
+    return client
+
+
 # ── LLM tests ──────────────────────────────────────────────────────────
 
 class TestLLM:
     @pytest.mark.asyncio
     async def test_returns_parsed_json(self):
         fake = _ollama_response("BLOCK_IP", "iptables -A INPUT -s 1.2.3.4 -j DROP")
-        with patch("app.llm.httpx.AsyncClient") as mock_cls:
-            mock_client = AsyncMock()
-            mock_resp = MagicMock()
-            mock_resp.json.return_value = {"message": {"content": fake}}
-            mock_resp.raise_for_status = MagicMock()
-            mock_client.post.return_value = mock_resp
-            mock_client.__aenter__ = AsyncMock(return_value=mock_client)
-            mock_client.__aexit__ = AsyncMock(return_value=False)
-            mock_cls.return_value = mock_client
 
+        with patch("app.llm._client", _ollama_stream(fake)):
             result = await ask_ollama({"rule": {"level": 10}}, "ubuntu")
 
         assert result["action"] == "BLOCK_IP"
         assert "iptables" in result["script"]
 
+    @pytest.mark.asyncio
+    async def test_user_message_is_compact(self):
+        client = _ollama_stream(_ollama_response("BLOCK_IP"))
+
+        with patch("app.llm._client", client):
+            await ask_ollama({"rule": {"id": "1", "level": 10}}, "ubuntu")
+
+        user_msg = json.loads(client.stream.call_args.kwargs["content"])["messages"][1]["content"]
+        assert user_msg == '{"alert":{"rule":{"id":"1","level":10}},"target_os":"ubuntu"}'
+
+    @pytest.mark.asyncio
+    async def test_prompt_drops_defaults_and_truncates_log(self):
+        client = _ollama_stream(_ollama_response("BLOCK_IP"))
+        alert = {
+            "timestamp": "2026-02-26T10:15:32Z",
+            "rule": {"id": "5710", "level": 10, "description": ""},
+            "agent": {"name": ""},
+            "data": {},
+            "full_log": "x" * 2000,
+        }
+
+        with patch("app.llm._client", client):
+            await ask_ollama(alert, "ubuntu")
+
+        sent = json.loads(json.loads(client.stream.call_args.kwargs["content"])["messages"][1]["content"])["alert"]
+        assert sent == {"rule": {"id": "5710", "level": 10}, "full_log": "x" * 500}
+
+    @pytest.mark.asyncio
+    async def test_ignore_stops_stream_early(self):
+        client = _ollama_stream(_ollama_response("IGNORE", "") + " " * 500)
+
+        with patch("app.llm._client", client):
+            result = await ask_ollama({"rule": {"level": 10}}, "ubuntu")
+
+        assert result["action"] == "IGNORE"
+        assert client.lines_read < len(client.lines)
+
+    @pytest.mark.asyncio
+    async def test_http_error_returns_ignore(self):
+        client = _ollama_stream("model not found", status_code=404)
+
+        with patch("app.llm._client", client):
+            result = await ask_ollama({"rule": {"level": 10}}, "ubuntu")
+
+        assert result["action"] == "IGNORE"
+        assert result["llm_error"] == "HTTP 404"
+        assert client.lines_read == 0
+
+
+    @pytest.mark.asyncio
+    async def test_client_carries_base_url_and_auth(self):
+        with patch("app.llm._client", None), patch("app.llm.OLLAMA_API_KEY", "secret"):
+            await llm.init_client()
+            client = llm._client
+            await llm.close_client()
+
+        assert str(client.base_url).rstrip("/") == llm.OLLAMA_BASE_URL
+        assert client.headers["Authorization"] == "Bearer secret"
+        assert client.headers["Content-Type"] == "application/json"
+
+    @pytest.mark.asyncio
+    async def test_batch_splits_decisions(self):
+        decisions = [json.loads(_ollama_response("BLOCK_IP")), json.loads(_ollama_response("IGNORE", ""))]
+        client = AsyncMock()
+        resp = MagicMock(status_code=200)
+        resp.aread = AsyncMock(return_value=json.dumps(
+            {"message": {"content": json.dumps({"decisions": decisions})}}
+        ).encode())
+        client.post.return_value = resp
+
+        with patch("app.llm._client", client):
+            result = await ask_ollama_batch([{"rule": {"id": "1"}}, {"rule": {"id": "2"}}], "ubuntu")
+
+        assert [d["action"] for d in result] == ["BLOCK_IP", "IGNORE"]
+
+        resp.aread.return_value = json.dumps({"message": {"content": json.dumps({"decisions": decisions[:1]})}}).encode()
+        with patch("app.llm._client", client), pytest.raises(ValueError):
+            await ask_ollama_batch([{"rule": {"id": "1"}}, {"rule": {"id": "2"}}], "ubuntu")
+
+        resp.aread.return_value = json.dumps(
+            {"message": {"content": json.dumps({"decisions": [decisions[0], ["IGNORE"]]})}}
+        ).encode()
+        with patch("app.llm._client", client), pytest.raises(ValueError):
+            await ask_ollama_batch([{"rule": {"id": "1"}}, {"rule": {"id": "2"}}], "ubuntu")
+
 
 # ── Executor tests ──────────────────────────────────────────────────────
 
 class TestExecutor:
+    @pytest.fixture(autouse=True)
+    def _empty_pool(self):
+        executor._conn_cache.clear()
+        executor._conn_used.clear()
+        yield
+        executor._conn_cache.clear()
+        executor._conn_used.clear()
+
     @pytest.mark.asyncio
     async def test_ssh_runs_script(self):
         mock_result = MagicMock(stdout="done\n", stderr="", exit_status=0)
@@ -71,6 +202,86 @@ class TestExecutor:
         assert result["success"] is False
         assert "SSH connection failed" in result["error"]
 
+    @pytest.mark.asyncio
+    async def test_ssh_reuses_connection(self):
+        mock_result = MagicMock(stdout="", stderr="", exit_status=0)
+        mock_conn = AsyncMock()
+        mock_conn.run = AsyncMock(return_value=mock_result)
+        mock_conn.is_closed = MagicMock(return_value=False)
+
+        with patch("app.executor.asyncssh.connect", new_callable=AsyncMock, return_value=mock_conn) as connect:
+            await run_ssh("10.0.0.1", 22, "admin", "echo one", password="x")
+            await run_ssh("10.0.0.1", 22, "admin", "echo two", password="x")
+
+        connect.assert_awaited_once()
+        assert mock_conn.run.await_count == 2
+
+    @pytest.mark.asyncio
+    async def test_ssh_reconnects_stale_pooled_connection(self):
+        stale = AsyncMock()
+        stale.is_closed = MagicMock(return_value=False)
+        stale.close = MagicMock()
+        stale.run = AsyncMock(side_effect=asyncssh.ChannelOpenError(2, "SSH connection closed"))
+        fresh = AsyncMock()
+        fresh.run = AsyncMock(return_value=MagicMock(stdout="ok", stderr="", exit_status=0))
+        executor._conn_cache[("10.0.0.1", 22, "admin")] = stale
+
+        with patch("app.executor.asyncssh.connect", new_callable=AsyncMock, return_value=fresh) as connect:
+            result = await run_ssh("10.0.0.1", 22, "admin", "echo hi", password="x")
+
+        assert result["success"] is True
+        connect.assert_awaited_once()
+        stale.close.assert_called_once()
+
+    @pytest.mark.asyncio
+    async def test_ssh_does_not_rerun_after_connection_lost_mid_command(self):
+        conn = AsyncMock()
+        conn.is_closed = MagicMock(return_value=False)
+        conn.close = MagicMock()
+
+        async def run(command, **_):
+            if "slow" in command:
+                await asyncio.sleep(0.01)
+                raise asyncssh.TimeoutError(None, command, None, None, None, None, "", "", "timed out")
+            await asyncio.sleep(0.02)  # in flight when the other job fails
+            raise asyncssh.ConnectionLost("connection lost")
+
+        conn.run = AsyncMock(side_effect=run)
+
+        with patch("app.executor.asyncssh.connect", new_callable=AsyncMock, return_value=conn) as connect:
+            slow, kill = await asyncio.gather(
+                run_ssh("10.0.0.1", 22, "admin", "slow", password="x"),
+                run_ssh("10.0.0.1", 22, "admin", "kill -9 1234", password="x"),
+            )
+
+        assert slow["success"] is False and kill["success"] is False
+        connect.assert_awaited_once()
+        assert conn.run.await_count == 2
+
+    @pytest.mark.asyncio
+    async def test_ssh_timeout_keeps_shared_connection(self):
+        conn = AsyncMock()
+        conn.is_closed = MagicMock(return_value=False)
+        conn.close = MagicMock()
+
+        async def run(command, **_):
+            if "slow" in command:
+                raise asyncssh.TimeoutError(None, command, None, None, None, None, "", "", "timed out")
+            await asyncio.sleep(0.01)
+            return MagicMock(stdout="ok", stderr="", exit_status=0)
+
+        conn.run = AsyncMock(side_effect=run)
+
+        with patch("app.executor.asyncssh.connect", new_callable=AsyncMock, return_value=conn):
+            slow, fast = await asyncio.gather(
+                run_ssh("10.0.0.1", 22, "admin", "slow", password="x"),
+                run_ssh("10.0.0.1", 22, "admin", "echo ok", password="x"),
+            )
+
+        assert slow["success"] is False and fast["success"] is True
+        conn.close.assert_not_called()
+        assert executor._conn_cache[("10.0.0.1", 22, "admin")] is conn
+
     @pytest.mark.asyncio
     async def test_windows_wraps_powershell(self):
         mock_result = MagicMock(stdout="ok\n", stderr="", exit_status=0)
@@ -91,7 +302,7 @@ class TestExecutor:
 class TestAPI:
     def _client(self):
         import app.main as m
-        m.AGENTS = AGENTS
+        m._set_agents(AGENTS)
         return TestClient(m.app)
 
     def test_health(self):
@@ -100,52 +311,169 @@ class TestAPI:
         assert r.status_code == 200
         assert r.json()["status"] == "ok"
 
-    def test_webhook_ignore(self):
+    def test_load_agents_ignores_unknown_keys(self, tmp_path):
+        from app import config
+        path = tmp_path / "agents.json"
+        path.write_text(json.dumps({"web": {"host": "10.0.0.3", "username": "ops", "tags": ["dmz"], "_comment": "x"}}))
+
+        with patch("app.config._AGENTS_FILE", str(path)):
+            agents = config.load_agents()
+
+        assert agents["web"] == AgentConfig(host="10.0.0.3", username="ops")
+
+    def test_log_handler_drops_when_full(self):
+        import queue
+        import app.main as m
+        handler = m._DroppingQueueHandler(queue.Queue(1))
+        record = m.log.makeRecord("soc", 20, __file__, 0, "msg", (), None)
+
+        handler.emit(record)
+        handler.emit(record)
+
+        assert handler.queue.qsize() == 1
+        assert handler.dropped == 1
+
+    def test_webhook_filtered(self):
+        c = self._client()
+        r = c.post("/webhook", json={
+            "rule": {"id": "1", "level": 2, "description": "heartbeat"},
+            "agent": {"name": "ubuntu-host"},
+            "full_log": "agent heartbeat",
+        })
+        assert r.json()["status"] == "filtered"
+
+    def test_webhook_rejects_invalid_body(self):
+        c = self._client()
+        with patch("app.main.rdb", _redis([0, 0])):
+            r = c.post("/webhook", content=b'{"rule": {"level": "high"}}', headers={"Content-Type": "application/json"})
+        assert r.status_code == 422
+        assert r.json()["detail"][0]["loc"] == ["rule", "level"]
+
+    @pytest.mark.parametrize("body", [
+        {"rule": {"id": 5710, "level": 10}, "agent": {"name": "ubuntu-host"}},
+        {"rule": {"id": "5710", "level": 10}, "agent": {"name": None}},
+        {"rule": {"id": ["5710"], "level": 10}, "agent": {"name": "ubuntu-host"}, "data": {"srcip": ["1.1.1.1"]}},
+    ])
+    def test_webhook_rejects_wrongly_typed_dedup_fields(self, body):
         c = self._client()
-        llm = _ollama_response("IGNORE", "")
-        with patch("app.main.ask_ollama", new_callable=AsyncMock, return_value=json.loads(llm)):
+        with patch("app.main.rdb", _redis([0, 0])):
+            r = c.post("/webhook", json=body)
+        assert r.status_code == 422
+
+    def test_webhook_duplicate(self):
+        c = self._client()
+        rdb = _redis([0, 1])
+
+        with patch("app.main.rdb", rdb):
             r = c.post("/webhook", json={
-                "rule": {"id": "1", "level": 2, "description": "heartbeat"},
+                "rule": {"id": "5710", "level": 10, "description": "brute force"},
                 "agent": {"name": "ubuntu-host"},
-                "full_log": "agent heartbeat",
+                "data": {"srcip": "5.5.5.5"},
             })
-        body = r.json()
-        assert body["decision"]["action"] == "IGNORE"
-        assert body["execution"]["executed"] is False
+        assert r.json()["status"] == "duplicate"
+        rdb.pipeline.return_value.xadd.assert_not_called()
 
-    def test_webhook_executes(self):
+    def test_webhook_dedup_disabled_with_zero_window(self):
+        import app.main as m
         c = self._client()
-        llm = json.loads(_ollama_response("BLOCK_IP", "iptables -A INPUT -s 5.5.5.5 -j DROP"))
-        ssh_result = {"success": True, "output": "rule added", "error": ""}
+        rdb = _redis([0, 1])
 
-        with (
-            patch("app.main.ask_ollama", new_callable=AsyncMock, return_value=llm),
-            patch("app.main.run_ssh", new_callable=AsyncMock, return_value=ssh_result),
-        ):
+        with patch("app.main.rdb", rdb), patch.object(m, "DEDUP_WINDOW", 0):
             r = c.post("/webhook", json={
                 "rule": {"id": "5710", "level": 10, "description": "brute force"},
                 "agent": {"name": "ubuntu-host"},
                 "data": {"srcip": "5.5.5.5"},
-                "full_log": "Failed password from 5.5.5.5",
             })
-        body = r.json()
-        assert body["decision"]["action"] == "BLOCK_IP"
-        assert body["execution"]["executed"] is True
-        assert body["execution"]["output"] == "rule added"
+            key = m._dedup_key("ubuntu-host", "5710", {"srcip": "5.5.5.5"})
+            asyncio.run(m._mark_seen(key))
+        assert r.json()["status"] == "queued"
+        rdb.pipeline.return_value.xadd.assert_called_once()
+        assert key not in m.DEDUP_CACHE
 
-    def test_webhook_unknown_agent(self):
+    def test_webhook_duplicate_skips_validation(self):
+        import app.main as m
         c = self._client()
-        llm = json.loads(_ollama_response("BLOCK_IP", "iptables ..."))
+        key = m._dedup_key("ubuntu-host", "5710", {"srcip": "6.6.6.6"})
 
-        with patch("app.main.ask_ollama", new_callable=AsyncMock, return_value=llm):
+        with _bloom() as bloom, patch("app.main.rdb", _redis()), patch.dict(m.DEDUP_CACHE, {key: True}), \
+                patch.object(m, "_validate") as validate:
+            bloom.add(key)
             r = c.post("/webhook", json={
-                "rule": {"id": "5710", "level": 10, "description": "scan"},
-                "agent": {"name": "unknown-box"},
-                "full_log": "nmap scan",
+                "rule": {"id": "5710", "level": 10, "description": "brute force"},
+                "agent": {"name": "ubuntu-host"},
+                "data": {"srcip": "6.6.6.6"},
+            })
+        assert r.json()["status"] == "duplicate"
+        validate.assert_not_called()
+
+    def test_webhook_duplicate_from_local_cache(self):
+        import app.main as m
+        c = self._client()
+        rdb = _redis()
+        key = m._dedup_key("ubuntu-host", "5710", {"srcip": "6.6.6.6"})
+
+        with _bloom() as bloom, patch("app.main.rdb", rdb), patch.dict(m.DEDUP_CACHE, {key: True}):
+            bloom.add(key)
+            r = c.post("/webhook", json={
+                "rule": {"id": "5710", "level": 10, "description": "brute force"},
+                "agent": {"name": "ubuntu-host"},
+                "data": {"srcip": "6.6.6.6"},
             })
+        assert r.json()["status"] == "duplicate"
+        rdb.pipeline.assert_not_called()
+
+    def test_webhook_batch_queues_in_one_pipeline(self):
+        import app.main as m
+        c = self._client()
+        # Bloom check for the new alert, then one pipeline for the enqueue.
+        rdb = _redis([0, 0], ["1-0", True, 7])
+        key = m._dedup_key("ubuntu-host", "5710", {"srcip": "6.6.6.6"})
+
+        with _bloom() as bloom, patch("app.main.rdb", rdb), patch.dict(m.DEDUP_CACHE, {key: True}):
+            bloom.add(key)
+            r = c.post("/webhook/batch", json=[
+                {"rule": {"id": "1", "level": 2, "description": "heartbeat"}, "agent": {"name": "ubuntu-host"}},
+                {"rule": {"id": "5712", "level": 10, "description": "ssh brute force"},
+                 "agent": {"name": "ubuntu-host"}, "data": {"srcip": "5.5.5.5"}},
+                {"rule": {"id": "5710", "level": 10, "description": "brute force"},
+                 "agent": {"name": "ubuntu-host"}, "data": {"srcip": "6.6.6.6"}},
+            ])
+
         body = r.json()
-        assert body["execution"]["executed"] is False
-        assert "not in inventory" in body["execution"]["error"]
+        assert [res["status"] for res in body["results"]] == ["filtered", "queued", "duplicate"]
+        assert body["queued"] == 1 and body["queue_length"] == 7
+        rdb.pipeline.return_value.xadd.assert_called_once()
+        job = json.loads(rdb.pipeline.return_value.xadd.call_args[0][1]["data"])
+        assert job["alert"]["data"] == {"srcip": "5.5.5.5"}
+        assert job["alert"]["full_log"] == ""
+
+    def test_job_returns_stored_json(self):
+        c = self._client()
+        rdb = _redis()
+        rdb.get.return_value = '{"status":"completed","action":"BLOCK_IP"}'
+
+        with patch("app.main.rdb", rdb):
+            r = c.get("/job/abc123")
+        assert r.headers["content-type"] == "application/json"
+        assert r.json() == {"status": "completed", "action": "BLOCK_IP"}
+
+    def test_clear_llm_cache(self):
+        import app.main as m
+        c = self._client()
+        rdb = _redis()
+
+        async def scan_iter(**_):
+            for key in ("soc:llm:a", "soc:llm:b"):
+                yield key
+
+        rdb.scan_iter = scan_iter
+        rdb.unlink.return_value = 2
+
+        with patch("app.main.rdb", rdb), patch.dict(m.LLM_CACHE, {m._decision_key({"rule": {"id": "5710"}}, "ubuntu"): {}}):
+            r = c.delete("/cache/llm")
+            assert len(m.LLM_CACHE) == 0
+        assert r.json() == {"local": 1, "shared": 2}
+        rdb.unlink.assert_awaited_once_with("soc:llm:a", "soc:llm:b")
 
     def test_analyze_dry_run(self):
         c = self._client()
@@ -164,3 +492,383 @@ class TestAPI:
         c = self._client()
         r = c.get("/audit")
         assert r.status_code == 200
+        assert r.headers["content-type"] == "application/x-ndjson"
+
+    def test_audit_pages_newest_first(self):
+        import app.main as m
+        c = self._client()
+        m.AUDIT.clear()
+        # Same millisecond for every record: paging must not rely on timestamps.
+        m.AUDIT.extend({"job_id": str(i), "seq": i, "completed_at": "2026-01-01T00:00:00.000Z"} for i in range(5))
+
+        r = c.get("/audit", params={"limit": 2})
+        assert [json.loads(line)["job_id"] for line in r.text.splitlines()] == ["4", "3"]
+
+        r = c.get("/audit", params={"limit": 2, "before": 3})
+        assert [json.loads(line)["job_id"] for line in r.text.splitlines()] == ["2", "1"]
+
+
+# ── Worker tests ────────────────────────────────────────────────────────
+
+def _job(alert, job_id="abc123"):
+    from app.main import WazuhAlert
+    dumped = WazuhAlert.model_validate(alert).model_dump()
+    return json.dumps({"job_id": job_id, "alert": dumped, "status": "queued", "queued_at": ""})
+
+
+class TestWorker:
+    @staticmethod
+    def _batching():
+        # Fresh queues per test: asyncio primitives bind to the first loop that waits on them.
+        import app.main as m
+        stack = ExitStack()
+        stack.enter_context(patch("app.main.LLM_BATCH_MAX", 4))
+        stack.enter_context(patch("app.main._llm_pending", asyncio.Event()))
+        stack.enter_context(patch("app.main._llm_bins", [asyncio.Queue() for _ in m._llm_bins]))
+        stack.enter_context(patch("app.main._llm_bin_flushed", [0] * len(m._llm_bins)))
+        return stack
+
+    def _main(self):
+        import app.main as m
+        m._set_agents(AGENTS)
+        m.AUDIT.clear()
+        m.DEDUP_CACHE.clear()
+        m.DEDUP_LOCAL_BLOOM.clear()
+        m.LLM_CACHE.clear()
+        while not m.SSH_QUEUE.empty():
+            m.SSH_QUEUE.get_nowait()
+        return m
+
+    @staticmethod
+    async def _run_ssh_queue(m):
+        while not m.SSH_QUEUE.empty():
+            await m._execute(m.SSH_QUEUE.get_nowait())
+
+    @pytest.mark.asyncio
+    async def test_process_executes(self):
+        m = self._main()
+        llm = json.loads(_ollama_response("BLOCK_IP", "iptables -A INPUT -s 5.5.5.5 -j DROP"))
+        ssh_result = {"success": True, "output": "rule added", "error": ""}
+
+        with (
+            patch("app.main.rdb", _redis()),
+            patch("app.main.ask_ollama", new_callable=AsyncMock, return_value=llm),
+            patch("app.main.run_ssh", new_callable=AsyncMock, return_value=ssh_result),
+        ):
+            await m._process_alert(_job({
+                "rule": {"id": "5710", "level": 10, "description": "brute force"},
+                "agent": {"name": "ubuntu-host"},
+                "data": {"srcip": "5.5.5.5"},
+                "full_log": "Failed password from 5.5.5.5",
+            }))
+            assert not m.AUDIT  # decided, waiting for an SSH worker
+            await self._run_ssh_queue(m)
+
+        entry = m.AUDIT[-1]
+        assert entry["action"] == "BLOCK_IP"
+        assert entry["executed"] is True
+        assert entry["output"] == "rule added"
+        assert entry["seq"] > 0
+
+    @pytest.mark.asyncio
+    async def test_process_unknown_agent(self):
+        m = self._main()
+        llm = json.loads(_ollama_response("BLOCK_IP", "iptables ..."))
+
+        with (
+            patch("app.main.rdb", _redis()),
+            patch("app.main.ask_ollama", new_callable=AsyncMock, return_value=llm),
+            patch("app.main.run_ssh", new_callable=AsyncMock) as ssh,
+        ):
+            await m._process_alert(_job({
+                "rule": {"id": "5710", "level": 10, "description": "scan"},
+                "agent": {"name": "unknown-box"},
+                "full_log": "nmap scan",
+            }))
+
+        ssh.assert_not_called()
+        assert m.AUDIT[-1]["executed"] is False
+
+    @pytest.mark.asyncio
+    async def test_decision_cache_hit_skips_llm(self):
+        m = self._main()
+        rdb = _redis()
+        rdb.get.return_value = _ollama_response("IGNORE", "")
+
+        with (
+            patch("app.main.rdb", rdb),
+            patch("app.main.ask_ollama", new_callable=AsyncMock) as llm,
+        ):
+            await m._process_alert(_job({
+                "rule": {"id": "5710", "level": 10, "description": "scan"},
+                "agent": {"name": "ubuntu-host"},
+            }))
+
+        llm.assert_not_called()
+        assert m.AUDIT[-1]["action"] == "IGNORE"
+        assert len(m.LLM_CACHE) == 0
+
+    @pytest.mark.asyncio
+    async def test_local_decision_cache_skips_redis_and_llm(self):
+        m = self._main()
+        rdb = _redis()
+        alert = {"rule": {"id": "5710", "level": 10}, "data": {"srcip": "5.5.5.5"}, "full_log": "kill 1234"}
+        decision = json.loads(_ollama_response("KILL_PROCESS", "kill -9 1234"))
+
+        with (
+            patch("app.main.rdb", rdb),
+            patch("app.main.ask_ollama", new_callable=AsyncMock, return_value=decision) as llm,
+        ):
+            first = await m._decide(alert, "ubuntu")
+            first["script"] = "mutated"
+            second = await m._decide(alert, "ubuntu")
+            other_log = await m._decide({**alert, "full_log": "kill 5678"}, "ubuntu")
+
+        assert second["script"] == "kill -9 1234"
+        assert other_log is not second
+        assert llm.await_count == 2
+        assert rdb.get.await_count == 2
+        assert m.LLM_CACHE_STATS["hits"] >= 1
+
+    @pytest.mark.asyncio
+    async def test_non_object_decision_is_not_cached(self):
+        m = self._main()
+        rdb = _redis()
+        alert = {"rule": {"id": "5710", "level": 10}, "data": {"srcip": "5.5.5.5"}}
+
+        with (
+            patch("app.main.rdb", rdb),
+            patch("app.main.ask_ollama", new_callable=AsyncMock, return_value=[{"action": "IGNORE"}]),
+            pytest.raises(ValueError),
+        ):
+            await m._decide(alert, "ubuntu")
+
+        rdb.setex.assert_not_called()
+        assert len(m.LLM_CACHE) == 0
+
+    def test_utc_now_is_iso8601(self):
+        from datetime import datetime, timezone
+        m = self._main()
+        stamp = m._utc_now()
+        parsed = datetime.fromisoformat(stamp.replace("Z", "+00:00"))
+        assert stamp.endswith("Z") and len(stamp) == 24
+        assert abs((datetime.now(timezone.utc) - parsed).total_seconds()) < 2
+
+    def test_decision_key_ignores_timestamps(self):
+        m = self._main()
+        a = {"timestamp": "2026-02-26T10:15:32Z", "full_log": "Feb 26 10:15:32 sshd: Failed password"}
+        b = {"timestamp": "2026-02-26T11:00:00Z", "full_log": "Feb 26 11:00:00 sshd: Failed password"}
+        assert m._decision_key(a, "ubuntu") == m._decision_key(b, "ubuntu")
+        assert m._decision_key(a, "ubuntu") != m._decision_key(a, "windows")
+
+    @pytest.mark.asyncio
+    async def test_mark_seen_joins_key_for_redis(self):
+        m = self._main()
+        rdb = _redis()
+        key = m._dedup_key("ubuntu-host", "5710", {"srcip": "5.5.5.5", "srcuser": "root"})
+
+        with _bloom() as bloom, patch("app.main.rdb", rdb), patch("app.main.DEDUP_BLOOM", False):
+            await m._mark_seen(key)
+
+        assert key == ("ubuntu-host", "5710", "5.5.5.5", "root")
+        assert key in m.DEDUP_CACHE and key in bloom
+        rdb.setex.assert_awaited_once_with("soc:dedup:key:ubuntu-host|5710|5.5.5.5|root", m.DEDUP_WINDOW, 1)
+
+    @pytest.mark.asyncio
+    async def test_static_rule_skips_llm(self):
+        m = self._main()
+        table = {"5712": {"action": "BLOCK_IP", "scripts": {"ubuntu": "iptables -A INPUT -s {srcip} -j DROP"}}}
+        ssh_result = {"success": True, "output": "", "error": ""}
+
+        with (
+            patch("app.main.rdb", _redis()),
+            patch("app.main.RULE_TABLE", table),
+            patch("app.main.ask_ollama", new_callable=AsyncMock) as llm,
+            patch("app.main.run_ssh", new_callable=AsyncMock, return_value=ssh_result) as ssh,
+        ):
+            assert await m._process_alert(_job({
+                "rule": {"id": "5712", "level": 10, "description": "brute force"},
+                "agent": {"name": "ubuntu-host"},
+                "data": {"srcip": "5.5.5.5"},
+            })) is True
+            await self._run_ssh_queue(m)
+
+        llm.assert_not_called()
+        assert ssh.call_args.kwargs["script"] == "iptables -A INPUT -s 5.5.5.5 -j DROP"
+
+    def test_static_rule_rejects_unsafe_values(self):
+        m = self._main()
+        table = {"5712": {"action": "BLOCK_IP", "scripts": {"ubuntu": "iptables -A INPUT -s {srcip} -j DROP"}}}
+
+        with patch("app.main.RULE_TABLE", table):
+            assert m._rule_decision("5712", {"srcip": "1.2.3.4; rm -rf /"}, "ubuntu") is None
+            assert m._rule_decision("5712", {}, "ubuntu") is None
+            assert m._rule_decision("5712", {"srcip": "1.2.3.4"}, "windows") is None
+
+    @pytest.mark.asyncio
+    async def test_llm_batcher_groups_by_os(self):
+        m = self._main()
+        decision = json.loads(_ollama_response("IGNORE", ""))
+
+        async def batch(alerts, target_os):
+            return [decision] * len(alerts)
+
+        with (
+            self._batching(),
+            patch("app.main.ask_ollama_batch", new_callable=AsyncMock, side_effect=batch) as batched,
+            patch("app.main.ask_ollama", new_callable=AsyncMock, return_value=decision) as single,
+        ):
+            task = asyncio.create_task(m._llm_batcher())
+            results = await asyncio.gather(
+                m._ask_llm({"n": 1}, "ubuntu"),
+                m._ask_llm({"n": 2}, "ubuntu"),
+                m._ask_llm({"n": 3}, "windows"),
+            )
+            task.cancel()
+
+        assert results == [decision] * 3
+        batched.assert_awaited_once_with([{"n": 1}, {"n": 2}], "ubuntu")
+        single.assert_awaited_once_with({"n": 3}, "windows")
+
+    @pytest.mark.asyncio
+    async def test_llm_batcher_keeps_severity_bins_apart(self):
+        m = self._main()
+        decision = json.loads(_ollama_response("IGNORE", ""))
+        high = [{"rule": {"level": 12}, "n": i} for i in range(2)]
+        mid = {"rule": {"level": 8}}
+
+        async def batch(alerts, target_os):
+            return [decision] * len(alerts)
+
+        with (
+            self._batching(),
+            patch("app.main.ask_ollama_batch", new_callable=AsyncMock, side_effect=batch) as batched,
+            patch("app.main.ask_ollama", new_callable=AsyncMock, return_value=decision) as single,
+        ):
+            task = asyncio.create_task(m._llm_batcher())
+            await asyncio.gather(*(m._ask_llm(a, "ubuntu") for a in [*high, mid]))
+            stats = m._llm_bin_stats()
+            task.cancel()
+
+        batched.assert_awaited_once_with(high, "ubuntu")
+        single.assert_awaited_once_with(mid, "ubuntu")
+        assert [b["levels"] for b in stats] == ["8-10", "11+"]
+        assert [b["batches"] for b in stats] == [1, 1]
+
+    @pytest.mark.asyncio
+    async def test_audit_flusher_writes_ndjson(self, tmp_path):
+        m = self._main()
+        path = tmp_path / "audit.jsonl"
+        queue = asyncio.Queue()
+        for i in range(3):
+            queue.put_nowait({"job_id": str(i)})
+
+        with (
+            patch("app.main.AUDIT_LOG", str(path)),
+            patch("app.main.AUDIT_QUEUE", queue),
+            patch("app.main.AUDIT_FLUSH_INTERVAL", 0.01),
+        ):
+            task = asyncio.create_task(m._audit_flusher())
+            await asyncio.sleep(0.1)
+            task.cancel()
+
+        assert [json.loads(line)["job_id"] for line in path.read_text().splitlines()] == ["0", "1", "2"]
+
+    @pytest.mark.asyncio
+    async def test_ssh_worker_acks_after_execution(self):
+        m = self._main()
+        rdb = _redis()
+        llm = json.loads(_ollama_response("BLOCK_IP", "iptables -A INPUT -s 5.5.5.5 -j DROP"))
+        ssh_result = {"success": True, "output": "", "error": ""}
+
+        with (
+            patch("app.main.rdb", rdb),
+            patch("app.main.SSH_QUEUE", asyncio.Queue()),
+            patch("app.main.ask_ollama", new_callable=AsyncMock, return_value=llm),
+            patch("app.main.run_ssh", new_callable=AsyncMock, return_value=ssh_result),
+        ):
+            await m._process_alert(_job({
+                "rule": {"id": "5710", "level": 10, "description": "brute force"},
+                "agent": {"name": "ubuntu-host"},
+                "data": {"srcip": "5.5.5.5"},
+            }), "7-0")
+            rdb.pipeline.return_value.xack.assert_not_called()
+            assert json.loads(rdb.setex.call_args[0][2])["status"] == "executing"
+
+            task = asyncio.create_task(m._ssh_worker())
+            await asyncio.sleep(0.05)
+            task.cancel()
+
+        rdb.pipeline.return_value.xack.assert_called_once_with(m.STREAM_KEY, m.GROUP, "7-0")
+        assert m.AUDIT[-1]["executed"] is True
+        assert "7-0" not in m._held
+
+    @pytest.mark.asyncio
+    async def test_audit_flusher_writes_collected_batch_on_cancel(self, tmp_path):
+        m = self._main()
+        path = tmp_path / "audit.jsonl"
+        queue = asyncio.Queue()
+        queue.put_nowait({"job_id": "0"})
+
+        with (
+            patch("app.main.AUDIT_LOG", str(path)),
+            patch("app.main.AUDIT_QUEUE", queue),
+            patch("app.main.AUDIT_FLUSH_INTERVAL", 10),
+        ):
+            task = asyncio.create_task(m._audit_flusher())
+            await asyncio.sleep(0.05)  # record taken, still waiting to fill the batch
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+
+        assert [json.loads(line)["job_id"] for line in path.read_text().splitlines()] == ["0"]
+
+    @pytest.mark.asyncio
+    async def test_next_batch_reads_group(self):
+        m = self._main()
+        rdb = AsyncMock()
+        rdb.xreadgroup.return_value = [("soc:stream", [("1-0", {"data": "a"}), ("2-0", {"data": "b"})])]
+
+        with patch("app.main.rdb", rdb):
+            batch = await m._next_batch("c0")
+
+        assert [fields["data"] for _, fields in batch] == ["a", "b"]
+        rdb.xautoclaim.assert_not_called()
+
+    @pytest.mark.asyncio
+    async def test_next_batch_reclaims_pending(self):
+        m = self._main()
+        rdb = AsyncMock()
+        rdb.xautoclaim.return_value = ["0-0", [("1-0", {"data": "a"})], []]
+
+        with patch("app.main.rdb", rdb):
+            batch = await m._next_batch("c0", reclaim=True)
+
+        assert batch == [("1-0", {"data": "a"})]
+        rdb.xreadgroup.assert_not_called()
+
+    @pytest.mark.asyncio
+    async def test_next_batch_skips_held_entries(self):
+        m = self._main()
+        rdb = AsyncMock()
+        rdb.xautoclaim.return_value = ["0-0", [("1-0", {"data": "a"}), ("2-0", {"data": "b"})], []]
+
+        with patch("app.main.rdb", rdb), patch.object(m, "_held", {"1-0"}):
+            batch = await m._next_batch("c0", reclaim=True)
+
+        assert batch == [("2-0", {"data": "b"})]
+
+    @pytest.mark.asyncio
+    async def test_refresh_held_resets_idle_time(self):
+        m = self._main()
+        rdb = AsyncMock()
+
+        with (
+            patch("app.main.rdb", rdb),
+            patch.object(m, "_held", {"1-0"}),
+            patch("app.main.HELD_REFRESH_INTERVAL", 0.01),
+        ):
+            task = asyncio.create_task(m._refresh_held("host-ssh"))
+            await asyncio.sleep(0.05)
+            task.cancel()
+
+        rdb.xclaim.assert_awaited_with(m.STREAM_KEY, m.GROUP, "host-ssh", 0, ["1-0"], justid=True)